@@ -3,22 +3,42 @@ import os
 import time
 import pandas as pd
 import threading
+import queue # For the background nurse-notes writer
+import atexit # For flushing queued notes on shutdown
+import contextlib # For the LLM slot context manager
+import string # For parsing prompt templates once at startup
+from collections import OrderedDict # For the LRU-bounded user context store
 from concurrent.futures import ThreadPoolExecutor, CancelledError, Future # Import Future for type hinting
-from flask import Flask, request, jsonify
+from concurrent.futures import wait as wait_for_futures # For waiting on a shared notes summary
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 from langchain_ollama import OllamaLLM
-from langchain_core.prompts import ChatPromptTemplate
+import httpx # For tuning the Ollama client's connection pool
 import uuid # For generating unique request IDs
 import datetime # For timestamps and cleanup logic
 import traceback # For detailed error logging
 import re # For regular expression matching (HETU)
-from typing import Dict, Any, Optional, Tuple, List # For type hinting
+import ahocorasick # For scanning messages for patient names/rooms in a single pass
+import json # For encoding streamed (SSE) chunks
+import csv # For quoting nurse notes written to nurse_notes.csv
+import io # For formatting a CSV row in memory
+from typing import Dict, Any, Optional, Tuple, List, Callable # For type hinting
 
 # --- Configuration Constants ---
 PATIENT_DATA_PATH = "patient_data.csv"
 NURSE_NOTES_PATH = "nurse_notes.csv"
-OLLAMA_MODEL_NAME = "irzumbm/pulseAITiny" # Specify the Ollama model to use
-MAX_WORKERS = 5 # Max concurrent requests processed by the thread pool
+OLLAMA_MODEL_NAME = os.environ.get("OLLAMA_MODEL_NAME", "irzumbm/pulseAITiny") # Ollama model to use (e.g. "gemma3:4b")
+USE_SYSTEM_INSTRUCTIONS = os.environ.get("USE_SYSTEM_INSTRUCTIONS", "0") == "1" # Send systemInstructions as a system message (for general models like gemma3:4b)
+OLLAMA_KEEPALIVE_SECONDS = 60 # How long idle connections to Ollama stay open for reuse
+OLLAMA_CONNECT_TIMEOUT_SECONDS = 10 # Fail fast if the Ollama server is unreachable
+OLLAMA_READ_TIMEOUT_SECONDS = 300 # Max wait for the next chunk of a generation (includes model load time)
+OLLAMA_KEEP_ALIVE = -1 # Keep the model (and its prompt cache) loaded between requests; -1 = indefinitely
+OLLAMA_PARALLEL_SLOTS = int(os.environ.get("OLLAMA_NUM_PARALLEL", "4")) # Generations Ollama batches together (same env var as the Ollama server)
+LLM_SLOT_POLL_SECONDS = 0.5 # How often a request waiting for an LLM slot checks whether it was cancelled
+MAX_MESSAGE_CHARS = 4000 # Longest /chat message or /record note accepted; longer ones are rejected with 413
+MAX_WORKERS = int(os.environ.get("PULSE_MAX_WORKERS", "5")) # Max concurrent requests processed by the thread pool
+MAX_QUEUED_REQUESTS = int(os.environ.get("PULSE_MAX_QUEUE", "20")) # Requests allowed to wait for a worker; more are rejected with 503
+NOTES_SUMMARY_WINDOW = 20 # Most recent notes sent to the LLM when summarizing a patient's notes
 CLEANUP_INTERVAL_SECONDS = 120 # How often the background cleanup runs (2 minutes)
 STALE_REQUEST_THRESHOLD_SECONDS = 300 # How long completed/errored requests stay before cleanup (5 minutes)
 PROCESSING_TIMEOUT_SECONDS = 600 # Optional: Timeout for requests stuck in 'processing' (10 minutes)
@@ -30,30 +50,44 @@ NOTES_PATIENT_ID_COLUMN = "PatientID" # Column name for Patient ID in nurse_note
 NOTES_NURSE_ID_COLUMN = "NurseID" # Column name for Nurse ID in nurse_notes.csv
 NOTES_DATE_COLUMN = "Date" # Column name for Date in nurse_notes.csv
 NOTES_NOTE_COLUMN = "Note" # Column name for Note content in nurse_notes.csv
+NOTES_WRITE_QUEUE_SIZE = 1000 # Max notes waiting for the background writer before /record rejects new ones
+NOTES_WRITE_BATCH_SECONDS = 0.2 # How long the writer collects notes before writing them as one batch
+NOTES_WRITE_MAX_BATCH = 100 # Max notes written (and fsynced) per batch
+NOTES_WRITE_FSYNC = os.environ.get("NOTES_FSYNC", "1") == "1" # fsync nurse_notes.csv after each batch so saved notes survive a crash ("0" leaves it to the OS)
+NOTES_WRITE_RETRY_SECONDS = 5 # Wait before retrying a batch that failed to write
+NOTE_NEWLINE_TRANSLATION = str.maketrans({"\n": " ", "\r": None}) # Newlines in a note become spaces before it is saved
+STREAM_KEEPALIVE_SECONDS = 15 # How often /stream sends a keep-alive comment while waiting for tokens
+CHAT_HISTORY_MAX_TURNS = 6 # Chat turns kept per user (and included in chat prompts)
+CHAT_HISTORY_MAX_TEXT_CHARS = 1000 # Longer user/AI texts are cut to this length in prompts (history keeps the full text)
+RECORD_HISTORY_PROMPT_TURNS = 5 # Most recent chat turns included in record confirmation prompts
+MAX_USER_CONTEXTS = 10000 # User contexts kept in memory; the least recently used are dropped beyond this
+USER_CONTEXT_IDLE_SECONDS = 12 * 60 * 60 # User contexts unused for this long (about a shift) are dropped by the cleanup thread
 
 # --- Initialize Flask App ---
 app = Flask(__name__)
 CORS(app) # Enable CORS for all origins for easier development/testing
 
 # --- Thread Safety Locks ---
-# Lock for accessing/modifying the shared user_contexts dictionary
+# Lock for accessing/modifying the shared user_contexts (and user_locks) dictionaries; held only briefly
 user_contexts_lock = threading.Lock()
 # Lock for accessing/modifying the shared active_requests dictionary
 active_requests_lock = threading.Lock()
+# Notified (under active_requests_lock) when a request streams new text or reaches a final state
+active_requests_changed = threading.Condition(active_requests_lock)
 
 # --- Model and Prompt Templates ---
-# Template for general chat interactions, focusing on context and patient info
+# Templates put static text first and per-request fields last: Ollama only reuses the cached
+# prompt processing (KV cache) for the prefix a prompt shares with the previous one.
+# System instructions for general-purpose models; the fine-tuned pulseAITiny model has this persona built in
+systemInstructions = """
+Your name is Pulse AI and you are a fellow digital nurse at all hospitals. Your main task is to help in summarizing and sharing patient data. You are a voice assistant that helps with managing workforce, providing important updates on patients and taking notes. Always keep your answer short and talk like a human would in a natural conversation.
+"""
+
+# Template for general chat interactions, focusing on context and patient info.
+# Ordered from most to least stable: static instructions, per-patient data, the conversation,
+# then the time and question, so follow-up questions share everything up to the conversation.
 chatTemplate = """
 Answer the question below, prioritizing information from the provided context. If you must provide information outside the context, explicitly state that it is not from the provided data. Do not fabricate information.
-Current Time: {current_time}
-
-Context: {context}
-
-Patient Details: {patient_details}
-
-Summarized Nurse Notes: {nurse_notes_result}
-
-Question: {question}
 
 Instructions:
 * Be concise and clear in your answer. Avoid any details that might not be useful to your fellow nurse.
@@ -65,6 +99,16 @@ Instructions:
 * Focus on the most relevant information for the question.
 * Always use patient's name when referring to them, and never their ID or SSN.
 
+Patient Details: {patient_details}
+
+Summarized Nurse Notes: {nurse_notes_result}
+
+Context: {context}
+
+Current Time: {current_time}
+
+Question: {question}
+
 Answer:
 """
 
@@ -72,15 +116,15 @@ Answer:
 recordingTemplate = """
 Answer the Question Below. If you are providing patient details, only provide information that can be found in the context and if you are providing something outside the context, mention that clearly.
 
-Here is the conversation history: {context}
+Generate a short confirmation message for the patient note that was just recorded, to keep the flow of the conversation going naturally.
 
-Here are the patient details: {patient_details}
+* Always use patient's name when referring to them, and never their ID or SSN.
 
-Here is the patient note that was just recorded: {patient_note}
+Here are the patient details: {patient_details}
 
-Generate a short confirmation message to keep the flow of the conversation going naturally.
+Here is the conversation history: {context}
 
-* Always use patient's name when referring to them, and never their ID or SSN.
+Here is the patient note that was just recorded: {patient_note}
 
 Response:
 """
@@ -89,60 +133,198 @@ Response:
 nurseNotesTemplate = """
 Answer the Question Below. If you are providing patient details, only provide information that can be found in the context and if you are providing something outside the context, mention that clearly.
 
+Given the list of nurse notes below, group the notes by common themes. For each theme, provide only the latest update based on the date associated with the note. Do not provide any reasoning or explanation for the grouping, just the themed summaries.
+
 Here are the raw nurse notes:
 {nurse_notes}
 
-Given the list of these notes, group the notes by common themes. For each theme, provide only the latest update based on the date associated with the note. Do not provide any reasoning or explanation for the grouping, just the themed summaries.
 Response:
 """
 
+# Template for updating an existing nurse notes summary with newly recorded notes
+nurseNotesUpdateTemplate = """
+Answer the Question Below. If you are providing patient details, only provide information that can be found in the context and if you are providing something outside the context, mention that clearly.
+
+Update the summary below with the new nurse notes, keeping it grouped by common themes. For each theme, provide only the latest update based on the date associated with the note. Do not provide any reasoning or explanation for the grouping, just the themed summaries.
+
+Here is the current summary of the nurse notes, grouped by theme:
+{previous_summary}
+
+Here are the new nurse notes recorded since that summary:
+{nurse_notes}
+
+Response:
+"""
+
+# --- Prompt Rendering ---
+def compile_prompt(template: str) -> Callable[..., str]:
+    """
+    Compiles a prompt template into a renderer, parsing its {placeholders} once at startup.
+    The rendered text is exactly what a ChatPromptTemplate | OllamaLLM chain sends to the model
+    ("Human: ..." or, with USE_SYSTEM_INSTRUCTIONS, "System: ...\nHuman: ..."), without running
+    LangChain's templating on every request.
+
+    Args:
+        template: Prompt template with {name} placeholders.
+
+    Returns:
+        A function taking the template variables as keyword arguments and returning the prompt.
+    """
+    prompt_text = f"System: {systemInstructions}\nHuman: {template}" if USE_SYSTEM_INSTRUCTIONS else f"Human: {template}"
+    # [(literal text, following placeholder name or None), ...]
+    segments = [(literal_text, field_name) for literal_text, field_name, _, _ in string.Formatter().parse(prompt_text)]
+
+    def render(**variables: Any) -> str:
+        pieces: List[str] = []
+        for literal_text, field_name in segments:
+            pieces.append(literal_text)
+            if field_name is not None:
+                pieces.append(str(variables[field_name]))
+        return "".join(pieces)
+
+    return render
+
+renderChatPrompt = compile_prompt(chatTemplate)
+renderRecordPrompt = compile_prompt(recordingTemplate)
+renderNurseNotesPrompt = compile_prompt(nurseNotesTemplate)
+renderNurseNotesUpdatePrompt = compile_prompt(nurseNotesUpdateTemplate)
+
 # --- Model Initialization ---
 model: Optional[OllamaLLM] = None
-chatChain: Optional[Any] = None
-recordChain: Optional[Any] = None
-nurseNotesChain: Optional[Any] = None
 
 try:
-    model = OllamaLLM(model=OLLAMA_MODEL_NAME)
+    # One pooled HTTP client is shared by all LLM calls. Keep enough idle connections for every
+    # worker that can be talking to Ollama at once, and keep them open between requests.
+    ollama_client_kwargs = {
+        "limits": httpx.Limits(
+            max_keepalive_connections=MAX_WORKERS,
+            max_connections=2 * MAX_WORKERS,
+            keepalive_expiry=OLLAMA_KEEPALIVE_SECONDS
+        ),
+        "timeout": httpx.Timeout(OLLAMA_READ_TIMEOUT_SECONDS, connect=OLLAMA_CONNECT_TIMEOUT_SECONDS)
+    }
+    model = OllamaLLM(model=OLLAMA_MODEL_NAME, keep_alive=OLLAMA_KEEP_ALIVE, client_kwargs=ollama_client_kwargs)
     # You could add other parameters here, e.g., temperature, max_tokens if needed
     # model = OllamaLLM(model=OLLAMA_MODEL_NAME, max_tokens=150)
     print(f"Ollama LLM initialized successfully with model: {OLLAMA_MODEL_NAME}")
 
-    # Create LangChain chains using the initialized model and prompts
-    chatPrompt = ChatPromptTemplate.from_template(chatTemplate)
-    recordPrompt = ChatPromptTemplate.from_template(recordingTemplate)
-    nurseNotesPrompt = ChatPromptTemplate.from_template(nurseNotesTemplate)
-    chatChain = chatPrompt | model
-    nurseNotesChain = nurseNotesPrompt | model
-    recordChain = recordPrompt | model
-    print("LangChain processing chains created.")
-
 except Exception as llm_err:
-    print(f"ERROR initializing Ollama LLM or creating chains: {llm_err}")
+    print(f"ERROR initializing Ollama LLM: {llm_err}")
     print("Ensure Ollama server is running and the specified model is available.")
     print("Server will run, but /chat, /record, and note summarization will fail.")
-    # model, chatChain, recordChain, nurseNotesChain remain None
+    # model remains None
 
 
 # --- Context Storage ---
+class LRUDict(OrderedDict):
+    """
+    Dictionary holding at most maxsize entries. Reading or writing an entry with [] marks it
+    as most recently used; inserting beyond maxsize evicts the least recently used entry.
+    If can_evict is given, entries whose value it rejects are never evicted (the dict may
+    then briefly hold more than maxsize entries).
+    Not thread-safe by itself; guard it with a lock like any shared dict here.
+    """
+    def __init__(self, maxsize: int, can_evict: Optional[Callable[[Any], bool]] = None):
+        super().__init__()
+        self.maxsize = maxsize
+        self.can_evict = can_evict
+        self.last_used: Dict[Any, float] = {} # key -> time.monotonic() of its last [] access
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        self.last_used[key] = time.monotonic()
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        self.last_used[key] = time.monotonic()
+        excess_count = len(self) - self.maxsize
+        if excess_count <= 0:
+            return
+        evicted_keys = []
+        for entry_key, entry_value in self.items(): # items() does not go through __getitem__, so it leaves the order alone
+            if len(evicted_keys) == excess_count or entry_key == key: # key was just moved to the end
+                break
+            if self.can_evict is None or self.can_evict(entry_value):
+                evicted_keys.append(entry_key)
+        for evicted_key in evicted_keys:
+            del self[evicted_key]
+            print(f"Evicted least recently used entry for user {evicted_key} (limit {self.maxsize}).")
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.last_used.pop(key, None)
+
+    def evict_idle(self, max_idle_seconds: float) -> int:
+        """
+        Drops the entries not accessed with [] for more than max_idle_seconds (except those
+        can_evict rejects). Entries are kept in order of use, so only the stale ones at the
+        front are looked at.
+
+        Args:
+            max_idle_seconds: How long an entry may go unused.
+
+        Returns:
+            The number of entries dropped.
+        """
+        cutoff = time.monotonic() - max_idle_seconds
+        stale_keys = []
+        for key, value in self.items(): # items() does not go through __getitem__, so it leaves the order alone
+            if self.last_used.get(key, cutoff) > cutoff:
+                break
+            if self.can_evict is None or self.can_evict(value):
+                stale_keys.append(key)
+        for key in stale_keys:
+            del self[key]
+        return len(stale_keys)
+
 # Global context string (can be set via API)
 global_context: str = ""
-# Dictionary to store context per user {user_id: {"patient_id": ..., "patient_details": ..., "nurse_notes": ..., "chat_history": [...]}}
-user_contexts: Dict[str, Dict[str, Any]] = {}
+# Dictionary to store context per user {user_id: {"patient_id": ..., "patient_details": ..., "nurse_notes": ..., "chat_history": [...], "chat_history_str": str}}
+# "chat_history" holds at most CHAT_HISTORY_MAX_TURNS turns; "chat_history_str" is those turns pre-formatted for the prompt
+# Bounded to MAX_USER_CONTEXTS users; an evicted user simply starts with a fresh context
+user_contexts: "LRUDict[str, Dict[str, Any]]" = LRUDict(MAX_USER_CONTEXTS)
+# Per-user locks serializing each user's context reads and updates, so users don't wait on each other.
+# Bounded like user_contexts, but a held lock is never evicted: its user's next request would get a new lock
+# and run alongside the request holding the old one.
+user_locks: "LRUDict[str, threading.Lock]" = LRUDict(MAX_USER_CONTEXTS, can_evict=lambda lock: not lock.locked())
+
+
+def _get_user_lock(user_id: str) -> threading.Lock:
+    """
+    Returns the lock serializing context updates for one user, creating it on first use.
+
+    Args:
+        user_id: The user whose lock is needed.
+
+    Returns:
+        The user's lock (not yet acquired).
+    """
+    with user_contexts_lock:
+        if user_id in user_locks:
+            return user_locks[user_id] # Indexing also marks the lock as recently used
+        lock = threading.Lock()
+        user_locks[user_id] = lock
+        return lock
 
 # --- Active Request Tracking ---
 # Stores information about ongoing asynchronous requests
-# Format: { request_id: {"future": Future, "status": str, "result": Optional[Any], "cancel_requested": bool, "user_id": str, "timestamp": datetime} }
+# Format: { request_id: {"future": Future, "status": str, "result": Optional[Any], "cancel_requested": bool, "user_id": str, "timestamp": float, "partial_response": str} }
+# "timestamp" is time.monotonic() of the last state change, so clock adjustments don't age requests
+# "partial_response" holds the LLM text generated so far while the request is processing
 # Status values: "processing", "cancelling", "completed", "error", "cancelled"
 active_requests: Dict[str, Dict[str, Any]] = {}
 
 # --- HETU (Finnish Personal Identity Code) Handling ---
-# Regex to find HETU with a century separator (+, -, A)
-# Format: DDMMYY<sep>NNNC where C is a checksum character
-HETU_WITH_SEP_REGEX = re.compile(r'\b(\d{6}[-+A]\d{3}[0-9A-FHJ-NPR-Y])\b', re.IGNORECASE)
-# Regex to find HETU without a separator (requires reconstruction)
-# Captures date part (DDMMYY) and identifier part (NNNC) separately
-HETU_WITHOUT_SEP_REGEX = re.compile(r'\b(\d{6})(\d{3}[0-9A-FHJ-NPR-Y])\b', re.IGNORECASE)
+# Regex to find HETUs in one pass, with or without the century separator
+# "sep": HETU with a century separator (+, -, A), format DDMMYY<sep>NNNC where C is a checksum character
+# "date"/"id": HETU without a separator (requires reconstruction), as date part (DDMMYY) and identifier part (NNNC)
+HETU_REGEX = re.compile(
+    r'\b(?:(?P<sep>\d{6}[-+A]\d{3}[0-9A-FHJ-NPR-Y])|(?P<date>\d{6})(?P<id>\d{3}[0-9A-FHJ-NPR-Y]))\b',
+    re.IGNORECASE
+)
 
 def reconstruct_hetu_with_separator(date_part: str, id_part: str) -> Optional[str]:
     """
@@ -198,12 +380,11 @@ def reconstruct_hetu_with_separator(date_part: str, id_part: str) -> Optional[st
 # --- Patient Data Loading ---
 patient_data: pd.DataFrame = pd.DataFrame() # Initialize as empty DataFrame
 try:
-    patient_data = pd.read_csv(PATIENT_DATA_PATH)
-    # Attempt to convert key columns to string immediately to avoid later issues
+    # Read every column as text exactly as written: lookups key on strings, and patient details only
+    # go into prompts, so type inference and NaN conversion would only have to be undone later.
+    patient_data = pd.read_csv(PATIENT_DATA_PATH, dtype=str, keep_default_na=False, engine="c")
     for col in [ROOM_NUMBER_COLUMN_NAME, SSN_COLUMN_NAME, PATIENT_ID_COLUMN_NAME, PATIENT_NAME_COLUMN_NAME]:
-         if col in patient_data.columns:
-              patient_data[col] = patient_data[col].astype(str)
-         else:
+         if col not in patient_data.columns:
               print(f"Warning: Expected column '{col}' not found in {PATIENT_DATA_PATH}. Patient lookups involving this column may fail.")
     print(f"Patient data loaded successfully from {PATIENT_DATA_PATH}")
 except FileNotFoundError:
@@ -213,14 +394,405 @@ except Exception as e:
     traceback.print_exc()
     # patient_data remains an empty DataFrame
 
+# --- Patient Lookup Indexes ---
+# patient_data is read once and never modified, so lookups and mention scanning use these
+# structures, built once here, instead of filtering the DataFrame on every request.
+PATIENTS_BY_ROOM: Dict[str, Dict[str, Any]] = {} # Room number -> first patient record in that room
+PATIENTS_BY_NAME: Dict[str, Dict[str, Any]] = {} # Lowercased name -> first patient record with that name
+PATIENTS_BY_SSN: Dict[str, Dict[str, Any]] = {} # Uppercased SSN/HETU -> first patient record with that SSN
+PATIENTS_BY_ID: Dict[str, Dict[str, Any]] = {} # Patient ID -> first patient record with that ID
+PATIENT_DETAILS_STRINGS: Dict[str, str] = {} # Patient ID -> patient_details_to_string() of PATIENTS_BY_ID record
+ROOM_MENTION_AUTOMATON: Optional[ahocorasick.Automaton] = None # Finds "room <n>" / "huone <n>" for any known room
+NAME_MENTION_AUTOMATON: Optional[ahocorasick.Automaton] = None # Finds any known patient name
+
+def _build_mention_automaton(keywords: Dict[str, str]) -> Optional[ahocorasick.Automaton]:
+    """
+    Builds an Aho-Corasick automaton that finds all of the given keywords in a single pass
+    over a message, however many keywords there are.
+
+    Args:
+        keywords: Lowercase keyword -> value to report when that keyword is found.
+
+    Returns:
+        The automaton, or None if there are no keywords.
+    """
+    if not keywords:
+        return None
+    automaton = ahocorasick.Automaton()
+    for keyword, value in keywords.items():
+        automaton.add_word(keyword, (len(keyword), value))
+    automaton.make_automaton()
+    return automaton
+
+def _find_first_mention(automaton: Optional[ahocorasick.Automaton], text_lower: str) -> Optional[str]:
+    """
+    Scans lowercased text with a mention automaton and returns the value of the earliest
+    keyword found. Among keywords starting at the same position the longest wins, so that
+    overlapping values (e.g. rooms "10" and "101") resolve to the most specific one.
+
+    Args:
+        automaton: Automaton from _build_mention_automaton (or None).
+        text_lower: The lowercased text to scan.
+
+    Returns:
+        The matched keyword's value, or None if no keyword occurs in the text.
+    """
+    if automaton is None:
+        return None
+    best_start, best_length, best_value = len(text_lower), 0, None
+    for end_index, (keyword_length, value) in automaton.iter(text_lower):
+        start_index = end_index - keyword_length + 1
+        if start_index < best_start or (start_index == best_start and keyword_length > best_length):
+            best_start, best_length, best_value = start_index, keyword_length, value
+    return best_value
+
+for patient_record in patient_data.to_dict('records'):
+    # Blank cells (read as "") are not indexed, so e.g. a missing room number never matches "room "
+    if patient_record.get(ROOM_NUMBER_COLUMN_NAME):
+        PATIENTS_BY_ROOM.setdefault(patient_record[ROOM_NUMBER_COLUMN_NAME], patient_record)
+    if patient_record.get(PATIENT_NAME_COLUMN_NAME):
+        PATIENTS_BY_NAME.setdefault(patient_record[PATIENT_NAME_COLUMN_NAME].lower(), patient_record)
+    if patient_record.get(SSN_COLUMN_NAME):
+        PATIENTS_BY_SSN.setdefault(patient_record[SSN_COLUMN_NAME].upper(), patient_record)
+    if patient_record.get(PATIENT_ID_COLUMN_NAME):
+        PATIENTS_BY_ID.setdefault(patient_record[PATIENT_ID_COLUMN_NAME], patient_record)
+
+ROOM_MENTION_AUTOMATON = _build_mention_automaton(
+    {f"{room_word} {room_number}".lower(): room_number for room_number in PATIENTS_BY_ROOM for room_word in ("room", "huone")}
+)
+NAME_MENTION_AUTOMATON = _build_mention_automaton({name_lower: name_lower for name_lower in PATIENTS_BY_NAME})
+print(f"Patient lookup indexes built: {len(PATIENTS_BY_ROOM)} rooms, {len(PATIENTS_BY_NAME)} names, {len(PATIENTS_BY_SSN)} SSNs.")
+
+# --- Nurse Notes Index ---
+# nurse_notes.csv is parsed once into notes_by_patient; /record appends to the file and the index
+# together, so requests never re-parse the CSV. Any other change to the file on disk (seen as a new
+# mtime/size signature) reloads the index and starts a new cache epoch.
+# Summaries from get_patient_notes (an LLM call each) are reused until the patient's notes change:
+# a saved note bumps only that patient's version; a reload keeps only the summaries whose notes it
+# left unchanged. Within an epoch notes are only appended, so a stale summary still covers a prefix
+# of the patient's notes and is updated incrementally with the notes after it.
+notes_lock = threading.Lock()
+notes_by_patient: Dict[str, List[Dict[str, str]]] = {} # patient_id -> [{"date": ..., "note": ...}] oldest first
+# Format: { patient_id: (epoch, version, notes_covered, summarized_notes_dict) }
+notes_summary_cache: Dict[str, Tuple[int, int, int, Dict[str, Any]]] = {}
+# Summaries being generated right now, keyed by (patient_id, epoch, version, notes_covered); requests
+# needing the same summary wait on its Future instead of making their own LLM call.
+# The Future's result is None if the summarizing request failed (e.g. was cancelled).
+notes_summaries_in_flight: Dict[Tuple[str, int, int, int], "Future[Optional[Dict[str, Any]]]"] = {}
+notes_versions: Dict[str, int] = {} # patient_id -> number of notes saved for it by this process
+notes_cache_epoch: int = 0
+notes_file_signature: Optional[Tuple[int, int]] = None # (st_mtime_ns, st_size) last loaded or written by this process
+# Notes are written to disk by a background writer thread. Each queued item is a
+# (patient_id, note_entry, utf8_csv_line) tuple; items stay in notes_pending until written,
+# so an index reload in the meantime does not drop them. None on the queue stops the writer.
+notes_write_queue: "queue.Queue[Optional[Tuple[str, Dict[str, str], bytes]]]" = queue.Queue(maxsize=NOTES_WRITE_QUEUE_SIZE)
+notes_pending: List[Tuple[str, Dict[str, str], bytes]] = []
+# Held by the writer while it appends to the notes file, so the write and fsync never block
+# notes_lock. Always taken before notes_lock, never while holding it.
+notes_file_lock = threading.Lock()
+
+def _read_notes_file_signature() -> Optional[Tuple[int, int]]:
+    """
+    Returns the (st_mtime_ns, st_size) signature of the notes file, or None if it cannot be read.
+    """
+    try:
+        stat_result = os.stat(NURSE_NOTES_PATH)
+    except OSError:
+        return None
+    return stat_result.st_mtime_ns, stat_result.st_size
+
+def _load_notes_index() -> Dict[str, List[Dict[str, str]]]:
+    """
+    Parses the notes file into a {patient_id: [{"date": ..., "note": ...}]} index, keeping
+    only rows with note content. Returns an empty index if the file is missing or unreadable.
+    """
+    try:
+        notes_df = pd.read_csv(
+            NURSE_NOTES_PATH,
+            usecols=[NOTES_DATE_COLUMN, NOTES_PATIENT_ID_COLUMN, NOTES_NOTE_COLUMN],
+            dtype=str, keep_default_na=False, skipinitialspace=True, engine="c"
+        )
+    except FileNotFoundError:
+        print(f"Warning: Notes file not found at {NURSE_NOTES_PATH}. Starting with no notes.")
+        return {}
+    except Exception as e:
+        print(f"Error reading nurse notes from {NURSE_NOTES_PATH}: {e}")
+        traceback.print_exc()
+        return {}
+
+    index: Dict[str, List[Dict[str, str]]] = {}
+    for patient_id, date_str, note_str in zip(notes_df[NOTES_PATIENT_ID_COLUMN], notes_df[NOTES_DATE_COLUMN], notes_df[NOTES_NOTE_COLUMN]):
+        if note_str: # Only include rows with actual note content
+            index.setdefault(patient_id, []).append({"date": date_str or 'N/A', "note": note_str})
+    # Sort each patient's notes by date once here ("YYYY-MM-DD HH:MM:SS" sorts as text, undated first);
+    # notes saved later are stamped with the current time, so appending keeps the order.
+    for patient_notes in index.values():
+        patient_notes.sort(key=lambda entry: "" if entry["date"] == 'N/A' else entry["date"])
+    return index
+
+def _reload_notes_index_if_changed():
+    """
+    Reloads notes_by_patient if the notes file changed on disk since this process last
+    loaded or wrote it. The reload starts a new epoch; cached summaries are carried into it
+    only if the notes they cover are unchanged, and the rest are dropped.
+    """
+    with notes_lock:
+        if _read_notes_file_signature() == notes_file_signature:
+            return
+    # The writer's own append also changes the signature until it records the new one. Reloading
+    # mid-write would index its batch twice (from the file and notes_pending), so leave the reload
+    # to a later read while the writer holds the file.
+    if not notes_file_lock.acquire(blocking=False):
+        return
+    try:
+        _reload_notes_index()
+    finally:
+        notes_file_lock.release()
+
+def _reload_notes_index():
+    """
+    Reloads notes_by_patient from the notes file unless its signature is unchanged.
+    The caller must hold notes_file_lock.
+    """
+    global notes_by_patient, notes_cache_epoch, notes_file_signature
+    with notes_lock:
+        signature = _read_notes_file_signature()
+        if signature == notes_file_signature:
+            return
+        previous_index = notes_by_patient
+        notes_by_patient = _load_notes_index()
+        for pending_patient_id, pending_entry, _ in notes_pending: # Not on disk yet
+            notes_by_patient.setdefault(pending_patient_id, []).append(pending_entry)
+        notes_cache_epoch += 1
+        notes_file_signature = signature
+        # Carry over summaries whose summarized notes (a prefix of the old list) are still the
+        # start of the patient's notes; any other edit makes them unusable
+        kept_summaries = 0
+        for cached_patient_id, (_, version, notes_covered, summary) in list(notes_summary_cache.items()):
+            covered_notes = previous_index.get(cached_patient_id, [])[:notes_covered]
+            if notes_by_patient.get(cached_patient_id, [])[:notes_covered] == covered_notes:
+                notes_summary_cache[cached_patient_id] = (notes_cache_epoch, version, notes_covered, summary)
+                kept_summaries += 1
+            else:
+                del notes_summary_cache[cached_patient_id]
+    if kept_summaries:
+        print(f"Kept {kept_summaries} cached notes summaries unaffected by the notes file change.")
+    print(f"Nurse notes index loaded from {NURSE_NOTES_PATH}: {sum(len(n) for n in notes_by_patient.values())} notes for {len(notes_by_patient)} patients.")
+
+def save_nurse_note(patient_id: str, date_str: str, note_str: str, note_csv_line: str):
+    """
+    Adds a note to the in-memory index immediately and queues it for the background
+    writer, so the request thread never waits on disk I/O.
+
+    Args:
+        patient_id: The patient the note belongs to.
+        date_str: The note's timestamp, as written to the file.
+        note_str: The note text as it reads back from the file (newlines removed, unquoted).
+        note_csv_line: The complete, already-escaped CSV line to append.
+
+    Raises:
+        UnicodeEncodeError: If the line cannot be written as UTF-8 (e.g. a lone surrogate);
+            the note is not saved or indexed.
+        queue.Full: If the writer's backlog is full; the note is not saved or indexed.
+    """
+    # Encode here so a note the file cannot hold fails its own request instead of the writer
+    pending_item = (patient_id, {"date": date_str, "note": note_str}, note_csv_line.encode("utf-8"))
+    with notes_lock:
+        notes_write_queue.put_nowait(pending_item)
+        notes_pending.append(pending_item)
+        notes_by_patient.setdefault(patient_id, []).append(pending_item[1])
+        notes_versions[patient_id] = notes_versions.get(patient_id, 0) + 1 # Makes the cached summary stale
+
+def _write_notes_batch(batch: List[Tuple[str, Dict[str, str], bytes]]) -> bool:
+    """
+    Appends a batch of queued notes to the notes file as one buffer (and fsyncs it). If the file
+    was unchanged since it was last loaded, records the post-write signature so the write is not
+    mistaken for an external change; otherwise the next read reloads the index.
+    The disk I/O runs under notes_file_lock only, so saving and reading notes never waits on it.
+    A failed write is truncated back to where it started, so a retry cannot duplicate rows.
+
+    Returns:
+        True if the batch was written, False if it should be retried.
+    """
+    global notes_file_signature
+    try:
+        with notes_file_lock:
+            with notes_lock:
+                # If the file changed since it was last loaded, recording the post-write signature
+                # would hide that change; leave the stored one stale so the next read reloads instead
+                file_unchanged = _read_notes_file_signature() == notes_file_signature
+            # 'ab' creates the file if needed; unbuffered so every byte written is accounted for
+            with open(NURSE_NOTES_PATH, 'ab', buffering=0) as file:
+                write_offset = file.seek(0, os.SEEK_END)
+                batch_bytes = b"".join(note_csv_line for _, _, note_csv_line in batch)
+                if write_offset == 0: # Empty file: write the header first
+                    header = f"{NOTES_DATE_COLUMN},{NOTES_NURSE_ID_COLUMN},{NOTES_PATIENT_ID_COLUMN},{NOTES_NOTE_COLUMN}\n"
+                    batch_bytes = header.encode("utf-8") + batch_bytes
+                try:
+                    remaining = memoryview(batch_bytes)
+                    while remaining:
+                        remaining = remaining[file.write(remaining):]
+                    if NOTES_WRITE_FSYNC:
+                        os.fsync(file.fileno())
+                except Exception:
+                    with contextlib.suppress(OSError): # Drop the partial batch; the retry rewrites all of it
+                        file.truncate(write_offset)
+                    raise
+            with notes_lock:
+                del notes_pending[:len(batch)] # Written in queue order
+                if file_unchanged:
+                    notes_file_signature = _read_notes_file_signature()
+        print(f"[Notes Writer] Saved {len(batch)} note(s) to {NURSE_NOTES_PATH}")
+        return True
+    except Exception as e: # Never let a bad batch kill the writer thread
+        print(f"[Notes Writer] Error writing {len(batch)} note(s) to {NURSE_NOTES_PATH}: {e}. Retrying in {NOTES_WRITE_RETRY_SECONDS}s.")
+        traceback.print_exc()
+        return False
+
+def _collect_notes_batch(batch: List[Tuple[str, Dict[str, str], bytes]]) -> bool:
+    """
+    Fills batch with queued notes: waits for the first one, then collects more for up to
+    NOTES_WRITE_BATCH_SECONDS (or NOTES_WRITE_MAX_BATCH notes).
+
+    Returns:
+        True if the None stop marker was taken from the queue.
+    """
+    first_item = notes_write_queue.get()
+    if first_item is None:
+        return True
+    batch.append(first_item)
+    batch_deadline = time.monotonic() + NOTES_WRITE_BATCH_SECONDS
+    while len(batch) < NOTES_WRITE_MAX_BATCH:
+        remaining_seconds = batch_deadline - time.monotonic()
+        if remaining_seconds <= 0:
+            break
+        try:
+            item = notes_write_queue.get(timeout=remaining_seconds)
+        except queue.Empty:
+            break
+        if item is None:
+            return True
+        batch.append(item)
+    return False
+
+def notes_writer():
+    """
+    Runs in a background thread: appends each batch of queued notes with one write and
+    retries failed batches until they are written. Exits after writing everything queued
+    before the None stop marker.
+    """
+    print("Notes writer thread started.")
+    stopping = False
+    while not stopping:
+        batch: List[Tuple[str, Dict[str, str], bytes]] = []
+        try:
+            stopping = _collect_notes_batch(batch)
+        except Exception as e: # Keep the thread alive; write whatever was collected
+            print(f"[Notes Writer] Unexpected error collecting notes: {e}")
+            traceback.print_exc()
+        while batch and not _write_notes_batch(batch):
+            time.sleep(NOTES_WRITE_RETRY_SECONDS)
+
+def _stop_notes_writer():
+    """
+    Flushes notes still queued when the process exits by stopping the writer and waiting for it.
+    """
+    try:
+        notes_write_queue.put(None, timeout=5)
+    except queue.Full:
+        print("[Notes Writer] Queue full at shutdown; waiting for the writer to catch up.")
+    notes_writer_thread.join(timeout=30)
+    if notes_pending:
+        print(f"[Notes Writer] Warning: {len(notes_pending)} note(s) were not written before shutdown.")
+
+_reload_notes_index_if_changed()
+notes_writer_thread = threading.Thread(target=notes_writer, daemon=True)
+notes_writer_thread.start()
+atexit.register(_stop_notes_writer)
+
 # --- Thread Pool Executor ---
 # Manages the worker threads for handling asynchronous requests (/chat, /record)
 executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
 print(f"ThreadPoolExecutor initialized with {MAX_WORKERS} workers.")
+# Bounds the requests running or waiting in the executor, whose own queue is unbounded;
+# /chat and /record answer 503 when none is free. Released when the request's future is done.
+request_slots = threading.BoundedSemaphore(MAX_WORKERS + MAX_QUEUED_REQUESTS)
+# Ollama batches up to OLLAMA_NUM_PARALLEL generations together and queues the rest internally.
+# Calls beyond that wait here instead (see llm_slot), where a cancelled request can still back out.
+llm_slots = threading.BoundedSemaphore(OLLAMA_PARALLEL_SLOTS)
 
 
 # --- Helper Functions ---
 
+def format_chat_turn(entry: Dict[str, str]) -> str:
+    """
+    Formats one chat history turn for inclusion in an LLM prompt. Texts longer than
+    CHAT_HISTORY_MAX_TEXT_CHARS are cut short, so one long answer doesn't inflate every later prompt.
+
+    Args:
+        entry: Chat history entry with "user" and "ai" keys.
+
+    Returns:
+        The formatted turn.
+    """
+    user_text, ai_text = entry['user'], entry['ai']
+    if len(user_text) > CHAT_HISTORY_MAX_TEXT_CHARS:
+        user_text = user_text[:CHAT_HISTORY_MAX_TEXT_CHARS] + "..."
+    if len(ai_text) > CHAT_HISTORY_MAX_TEXT_CHARS:
+        ai_text = ai_text[:CHAT_HISTORY_MAX_TEXT_CHARS] + "..."
+    return f"User: {user_text}\nAI: {ai_text}"
+
+
+def append_chat_history(user_context: Dict[str, Any], user_text: str, ai_text: str):
+    """
+    Appends a turn to a user's chat history, keeping only the last CHAT_HISTORY_MAX_TURNS
+    turns and refreshing the pre-formatted "chat_history_str" used in prompts.
+    Must be called with user_contexts_lock held.
+
+    Args:
+        user_context: The user's entry in user_contexts.
+        user_text: What the user said (or did).
+        ai_text: The AI's response.
+    """
+    # Ensure 'chat_history' key exists and is a list
+    if not isinstance(user_context.get("chat_history"), list):
+        user_context["chat_history"] = []
+    chat_history = user_context["chat_history"]
+    chat_history.append({"user": user_text, "ai": ai_text})
+    del chat_history[:-CHAT_HISTORY_MAX_TURNS] # Prompt size stays bounded however long the session runs
+    user_context["chat_history_str"] = "\n".join(format_chat_turn(entry) for entry in chat_history)
+
+
+def handsfree_prefix(patient_details: Optional[Dict[str, Any]], request_id: str) -> str:
+    """
+    Builds the prefix that names the patient in handsfree responses, so the nurse
+    hears which patient an answer is about.
+
+    Args:
+        patient_details: The patient the response is about, if any.
+        request_id: The ID of the current request for logging.
+
+    Returns:
+        "For <name> with SSN ID ending in <last 4>, ", or "" if the patient's
+        name or SSN is unavailable.
+    """
+    if not patient_details:
+        print(f"[{request_id}] Handsfree active, but no patient context available for prefix.")
+        return ""
+    patient_name = patient_details.get(PATIENT_NAME_COLUMN_NAME)
+    ssn = patient_details.get(SSN_COLUMN_NAME)
+    if not patient_name or not ssn:
+        print(f"[{request_id}] Handsfree active, but missing patient name or SSN in context for prefix.")
+        return ""
+    ssn_str = str(ssn)
+    # Check length for safety, HETU is longer but standard SSN might be shorter
+    if len(ssn_str) < 4:
+        print(f"[{request_id}] Handsfree active, but SSN '{ssn_str}' too short for prefix.")
+        return ""
+    print(f"[{request_id}] Applying handsfree prefix.")
+    return f"For {patient_name} with SSN ID ending in {ssn_str[-4:]}, "
+
+
 def patient_details_to_string(patient_dict: Optional[Dict[str, Any]]) -> str:
     """
     Converts a patient data dictionary into a simple string format for LLM context.
@@ -234,13 +806,21 @@ def patient_details_to_string(patient_dict: Optional[Dict[str, Any]]) -> str:
     """
     if not patient_dict:
         return "No patient details available."
+    # Records from the lookup indexes have their string prebuilt at startup
+    patient_id = patient_dict.get(PATIENT_ID_COLUMN_NAME)
+    if patient_id in PATIENT_DETAILS_STRINGS and PATIENTS_BY_ID.get(patient_id) is patient_dict:
+        return PATIENT_DETAILS_STRINGS[patient_id]
     # Filter for basic types easily representable as strings
     primitive_dict = {k: v for k, v in patient_dict.items() if isinstance(v, (str, int, float, bool))}
     return ", ".join(f"{key}: {value}" for key, value in primitive_dict.items())
 
+# Patient records never change, so format each indexed patient's details once
+for indexed_patient_id, indexed_record in PATIENTS_BY_ID.items():
+    PATIENT_DETAILS_STRINGS[indexed_patient_id] = patient_details_to_string(indexed_record)
+
 def get_patient_details_by_room(room_number: str) -> Optional[Tuple[Dict[str, Any], str]]:
     """
-    Finds a patient by matching the room number. Assumes ROOM_NUMBER_COLUMN_NAME exists and is string type.
+    Finds a patient by matching the room number, using the prebuilt PATIENTS_BY_ROOM index.
 
     Args:
         room_number: The room number to search for (as a string).
@@ -252,27 +832,20 @@ def get_patient_details_by_room(room_number: str) -> Optional[Tuple[Dict[str, An
     if patient_data.empty or ROOM_NUMBER_COLUMN_NAME not in patient_data.columns:
         print(f"Warning: Cannot search by room '{room_number}'. Patient data empty or missing '{ROOM_NUMBER_COLUMN_NAME}' column.")
         return None
-    try:
-        # Direct string comparison since column was pre-converted
-        patient_info = patient_data[patient_data[ROOM_NUMBER_COLUMN_NAME] == room_number]
-        if not patient_info.empty:
-            patient = patient_info.iloc[0].to_dict()
-            patient_id = patient.get(PATIENT_ID_COLUMN_NAME)
-            if not patient_id:
-                 print(f"Warning: Found patient in room {room_number} but missing '{PATIENT_ID_COLUMN_NAME}'.")
-                 # Decide if you want to return the patient dict anyway, or None
-                 # return patient, None # Option 1: Return details without ID
-                 return None # Option 2: Consider it a failure if ID is missing
-            print(f"Patient detected by room: {room_number}, Name: {patient.get(PATIENT_NAME_COLUMN_NAME)}, ID: {patient_id}")
-            return patient, str(patient_id) # Ensure ID is string
-    except Exception as e:
-        print(f"Error getting patient by room {room_number}: {e}")
-        traceback.print_exc()
+    patient = PATIENTS_BY_ROOM.get(str(room_number))
+    if patient:
+        patient_id = patient.get(PATIENT_ID_COLUMN_NAME)
+        if not patient_id:
+             print(f"Warning: Found patient in room {room_number} but missing '{PATIENT_ID_COLUMN_NAME}'.")
+             return None # Consider it a failure if ID is missing
+        print(f"Patient detected by room: {room_number}, Name: {patient.get(PATIENT_NAME_COLUMN_NAME)}, ID: {patient_id}")
+        return patient, str(patient_id) # Ensure ID is string
     return None
 
 def get_patient_details_by_name(patient_name: str) -> Optional[Tuple[Dict[str, Any], str]]:
     """
-    Finds a patient by partially matching the name (case-insensitive). Assumes PATIENT_NAME_COLUMN_NAME exists.
+    Finds a patient by name (case-insensitive). An exact name is an O(1) hit on the
+    PATIENTS_BY_NAME index; otherwise falls back to a partial match over the indexed names.
 
     Args:
         patient_name: The name (or part of it) to search for.
@@ -284,28 +857,26 @@ def get_patient_details_by_name(patient_name: str) -> Optional[Tuple[Dict[str, A
     if patient_data.empty or PATIENT_NAME_COLUMN_NAME not in patient_data.columns:
         print(f"Warning: Cannot search by name '{patient_name}'. Patient data empty or missing '{PATIENT_NAME_COLUMN_NAME}' column.")
         return None
-    try:
-        # Case-insensitive containment search, handling potential NaN values
-        patient_info = patient_data[patient_data[PATIENT_NAME_COLUMN_NAME].str.contains(patient_name, case=False, na=False)]
-        if not patient_info.empty:
-            if len(patient_info) > 1:
-                print(f"Warning: Multiple patients found for name '{patient_name}'. Using the first match.")
-            patient = patient_info.iloc[0].to_dict()
-            patient_id = patient.get(PATIENT_ID_COLUMN_NAME)
-            if not patient_id:
-                 print(f"Warning: Found patient matching name '{patient_name}' but missing '{PATIENT_ID_COLUMN_NAME}'.")
-                 return None # Require Patient ID for a valid match
-            print(f"Patient detected by name: {patient_name}, ID: {patient_id}")
-            return patient, str(patient_id) # Ensure ID is string
-    except Exception as e:
-        print(f"Error getting patient by name '{patient_name}': {e}")
-        traceback.print_exc()
+    search_name_lower = patient_name.lower()
+    patient = PATIENTS_BY_NAME.get(search_name_lower)
+    if patient is None:
+        partial_matches = [record for name_lower, record in PATIENTS_BY_NAME.items() if search_name_lower in name_lower]
+        if len(partial_matches) > 1:
+            print(f"Warning: Multiple patients found for name '{patient_name}'. Using the first match.")
+        patient = partial_matches[0] if partial_matches else None
+    if patient:
+        patient_id = patient.get(PATIENT_ID_COLUMN_NAME)
+        if not patient_id:
+             print(f"Warning: Found patient matching name '{patient_name}' but missing '{PATIENT_ID_COLUMN_NAME}'.")
+             return None # Require Patient ID for a valid match
+        print(f"Patient detected by name: {patient_name}, ID: {patient_id}")
+        return patient, str(patient_id) # Ensure ID is string
     return None
 
 def get_patient_details_by_ssn(ssn: str) -> Optional[Tuple[Dict[str, Any], str]]:
     """
     Retrieves patient details based on an exact SSN/HETU match.
-    Uses the SSN_COLUMN_NAME constant. Compares using uppercase canonical HETU format.
+    Uses the prebuilt PATIENTS_BY_SSN index, keyed by uppercase canonical HETU format.
 
     Args:
         ssn: The SSN/HETU string to search for (should be in canonical uppercase format).
@@ -322,13 +893,9 @@ def get_patient_details_by_ssn(ssn: str) -> Optional[Tuple[Dict[str, Any], str]]
     search_ssn_upper = str(ssn).upper()
 
     try:
-        # Direct comparison since column was pre-converted to string and search term is uppercase
-        patient_info = patient_data[patient_data[SSN_COLUMN_NAME].str.upper() == search_ssn_upper]
+        patient = PATIENTS_BY_SSN.get(search_ssn_upper)
 
-        if not patient_info.empty:
-            if len(patient_info) > 1:
-                print(f"Warning: Multiple patients found for SSN {ssn}. Using the first match.")
-            patient = patient_info.iloc[0].to_dict()
+        if patient:
             patient_id = patient.get(PATIENT_ID_COLUMN_NAME)
             if not patient_id:
                  print(f"Warning: Found patient with SSN '{ssn}' but missing '{PATIENT_ID_COLUMN_NAME}'.")
@@ -364,46 +931,41 @@ def _identify_patient(text_to_search: str, request_id: str) -> Optional[Tuple[Di
         print(f"[{request_id}] Patient identification skipped: Patient data is empty.")
         return None
 
-    # 1. Check by Room Number
-    if ROOM_NUMBER_COLUMN_NAME in patient_data.columns:
-        # Iterate through unique room numbers present in the data
-        for room_number_str in patient_data[ROOM_NUMBER_COLUMN_NAME].dropna().unique():
-            # Check for "room X" or just "X" (adjust pattern if needed)
-            if f"room {room_number_str}" in text_to_search.lower() or \
-               f"huone {room_number_str}" in text_to_search.lower() or \
-               room_number_str == text_to_search.strip():
-                result = get_patient_details_by_room(room_number_str)
-                if result:
-                    print(f"[{request_id}] Patient identified in text by Room: {room_number_str}")
-                    return result
-
-    # 2. Check by Name (if not found by room)
-    if PATIENT_NAME_COLUMN_NAME in patient_data.columns:
-        # Iterate through unique names (more robust might be needed for partial matches)
-        for name in patient_data[PATIENT_NAME_COLUMN_NAME].dropna().unique():
-             # Simple substring check (case-insensitive). Might need refinement (e.g., word boundaries)
-             if name.lower() in text_to_search.lower():
-                 result = get_patient_details_by_name(name)
-                 if result:
-                     print(f"[{request_id}] Patient identified in text by Name: {name}")
-                     return result # Return first name match
-
-    # 3. Check by SSN/HETU (if not found by room or name)
+    text_lower = text_to_search.lower()
+
+    # 1. Check by Room Number: one automaton pass for "room X"/"huone X", or the whole input being a room number
+    room_number_str = _find_first_mention(ROOM_MENTION_AUTOMATON, text_lower) or text_to_search.strip()
+    if room_number_str in PATIENTS_BY_ROOM:
+        result = get_patient_details_by_room(room_number_str)
+        if result:
+            print(f"[{request_id}] Patient identified in text by Room: {room_number_str}")
+            return result
+
+    # 2. Check by Name (if not found by room): one automaton pass over the lowercased text for all names
+    name = _find_first_mention(NAME_MENTION_AUTOMATON, text_lower)
+    if name:
+        result = get_patient_details_by_name(name)
+        if result:
+            print(f"[{request_id}] Patient identified in text by Name: {name}")
+            return result # Return first name match
+
+    # 3. Check by SSN/HETU (if not found by room or name): one regex pass for both forms
     if SSN_COLUMN_NAME in patient_data.columns:
-        # 3a. Try matching HETU WITH separator first
-        potential_ssns_with_sep = HETU_WITH_SEP_REGEX.findall(text_to_search)
-        if potential_ssns_with_sep:
-            print(f"[{request_id}] Potential HETU (with sep) found in text: {potential_ssns_with_sep}")
-            for potential_ssn in potential_ssns_with_sep:
-                # Uppercase for consistent lookup
-                found_hetu_canonical = potential_ssn.upper()
-                result = get_patient_details_by_ssn(found_hetu_canonical)
-                if result:
-                    print(f"[{request_id}] Patient identified in text by SSN (with sep): {found_hetu_canonical}")
-                    return result # Stop after first valid SSN match
-
-        # 3b. If not found, try matching HETU WITHOUT separator
-        potential_ssns_without_sep = HETU_WITHOUT_SEP_REGEX.findall(text_to_search)
+        # 3a. HETUs WITH separator are tried as they are found; ones without are kept for 3b
+        potential_ssns_without_sep: List[Tuple[str, str]] = []
+        for hetu_match in HETU_REGEX.finditer(text_to_search):
+            if not hetu_match["sep"]:
+                potential_ssns_without_sep.append((hetu_match["date"], hetu_match["id"]))
+                continue
+            # Uppercase for consistent lookup
+            found_hetu_canonical = hetu_match["sep"].upper()
+            print(f"[{request_id}] Potential HETU (with sep) found in text: {found_hetu_canonical}")
+            result = get_patient_details_by_ssn(found_hetu_canonical)
+            if result:
+                print(f"[{request_id}] Patient identified in text by SSN (with sep): {found_hetu_canonical}")
+                return result # Stop after first valid SSN match
+
+        # 3b. If not found, try the HETUs WITHOUT separator
         if potential_ssns_without_sep:
             print(f"[{request_id}] Potential HETU (without sep) found in text: {potential_ssns_without_sep}")
             for date_part, id_part in potential_ssns_without_sep:
@@ -425,8 +987,8 @@ def _identify_patient(text_to_search: str, request_id: str) -> Optional[Tuple[Di
 
 def get_patient_notes(patient_id: str, request_id: str) -> Dict[str, Any]:
     """
-    Retrieves raw patient notes from the CSV file, filters them for the given patient ID,
-    and then uses the nurseNotesChain (LLM) to summarize them by theme.
+    Returns the summarized nurse notes for a patient, reusing the cached summary
+    while the patient's notes are unchanged and summarizing them otherwise.
 
     Args:
         patient_id: The ID of the patient whose notes are needed.
@@ -439,62 +1001,127 @@ def get_patient_notes(patient_id: str, request_id: str) -> Dict[str, Any]:
     if not patient_id:
         return {"error": "No patient ID provided for notes lookup."}
 
-    # --- 1. Read and Filter Notes ---
+    _reload_notes_index_if_changed()
+    with notes_lock:
+        cache_key = (notes_cache_epoch, notes_versions.get(patient_id, 0))
+        cached_entry = notes_summary_cache.get(patient_id)
+        notes_list = list(notes_by_patient.get(str(patient_id), ()))
+    if cached_entry and cached_entry[:2] == cache_key and cached_entry[2] == len(notes_list):
+        print(f"[{request_id}] Using cached notes summary for patient {patient_id}.")
+        return cached_entry[3]
+
+    # Share the summary with any request already generating it for the same notes
+    in_flight_key = (patient_id, *cache_key, len(notes_list))
+    with notes_lock:
+        in_flight = notes_summaries_in_flight.get(in_flight_key)
+        if in_flight is None:
+            in_flight = notes_summaries_in_flight[in_flight_key] = Future()
+            is_summarizing_request = True
+        else:
+            is_summarizing_request = False
+    if not is_summarizing_request:
+        print(f"[{request_id}] Waiting for the notes summary already being generated for patient {patient_id}.")
+        while not wait_for_futures([in_flight], timeout=LLM_SLOT_POLL_SECONDS).done:
+            with active_requests_lock:
+                request_info = active_requests.get(request_id)
+                if request_info and request_info.get("cancel_requested", False):
+                    print(f"[{request_id}] Cancellation detected while waiting for a shared notes summary.")
+                    raise CancelledError(f"Request {request_id} cancelled while waiting for a notes summary.")
+        shared_summary = in_flight.result()
+        if shared_summary is not None:
+            return shared_summary
+        # The summarizing request failed; try again (this request may now be the one summarizing)
+        return get_patient_notes(patient_id, request_id)
+
+    summarized_notes: Optional[Dict[str, Any]] = None
     try:
-        nurse_notes_df = pd.read_csv(NURSE_NOTES_PATH)
-    except FileNotFoundError:
-        return {"error": f"Notes file not found at {NURSE_NOTES_PATH}."}
-    except Exception as e:
-        print(f"[{request_id}] Error reading {NURSE_NOTES_PATH}: {e}")
-        return {"error": f"Error reading nurse notes file: {e}"}
-
-    if NOTES_PATIENT_ID_COLUMN not in nurse_notes_df.columns:
-        return {"error": f"Required column '{NOTES_PATIENT_ID_COLUMN}' not found in notes file."}
+        summarized_notes = _summarize_cache_miss(notes_list, cached_entry, cache_key, patient_id, request_id)
+    finally:
+        with notes_lock:
+            notes_summaries_in_flight.pop(in_flight_key, None)
+        in_flight.set_result(summarized_notes)
+    return summarized_notes
+
+def _summarize_cache_miss(notes_list: List[Dict[str, str]], cached_entry: Optional[Tuple[int, int, int, Dict[str, Any]]],
+                          cache_key: Tuple[int, int], patient_id: str, request_id: str) -> Dict[str, Any]:
+    """
+    Summarizes a patient's notes for get_patient_notes after a cache miss and caches the result.
 
-    try:
-        # Ensure comparison is done using string types
-        notes_df = nurse_notes_df[nurse_notes_df[NOTES_PATIENT_ID_COLUMN].astype(str) == str(patient_id)]
-    except Exception as e:
-        print(f"[{request_id}] Error filtering notes for patient ID {patient_id}: {e}")
-        return {"error": f"Error filtering notes: {e}"}
+    Args:
+        notes_list: All of the patient's notes, oldest first.
+        cached_entry: The patient's (stale) notes_summary_cache entry, if any.
+        cache_key: The (epoch, version) the notes_list was read at.
+        patient_id: The ID of the patient whose notes are summarized.
+        request_id: The ID of the current request for logging and cancellation checks.
 
-    if notes_df.empty:
-        return {"summary": "No notes available for this patient."} # Return summary indicating no notes
+    Returns:
+        A dictionary containing the summarized notes under the key "summary",
+        or an error message under the key "error".
+    """
+    # A summary from earlier in this epoch covers notes_list[:notes_covered]; update it with the
+    # notes added since, as long as they fit the window. Otherwise summarize the latest notes afresh.
+    previous_summary: Optional[str] = None
+    notes_to_summarize = notes_list[-NOTES_SUMMARY_WINDOW:]
+    if cached_entry and cached_entry[0] == cache_key[0]:
+        notes_covered = cached_entry[2]
+        if 0 < notes_covered < len(notes_list) and len(notes_list) - notes_covered <= NOTES_SUMMARY_WINDOW:
+            previous_summary = str(cached_entry[3]["summary"])
+            notes_to_summarize = notes_list[notes_covered:]
+
+    summarized_notes = _summarize_patient_notes(notes_to_summarize, patient_id, request_id, previous_summary)
+    if "summary" in summarized_notes:
+        with notes_lock:
+            # Only publish if no note was saved (and the index was not reloaded) while summarizing
+            if (notes_cache_epoch, notes_versions.get(patient_id, 0)) == cache_key:
+                notes_summary_cache[patient_id] = (*cache_key, len(notes_list), summarized_notes)
+    return summarized_notes
+
+def _summarize_patient_notes(notes_list: List[Dict[str, str]], patient_id: str, request_id: str,
+                             previous_summary: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Uses the LLM with the nurse notes prompt to summarize a patient's notes by theme,
+    or to update previous_summary with the given (newer) notes if one is provided.
 
-    # --- 2. Format Notes for LLM ---
-    notes_list: List[Dict[str, str]] = []
-    for _, row in notes_df.iterrows():
-        try:
-            note_dict = row.to_dict()
-            # Use defined column constants and provide defaults
-            date_str = str(note_dict.get(NOTES_DATE_COLUMN, 'N/A'))
-            note_str = str(note_dict.get(NOTES_NOTE_COLUMN, ''))
-            if note_str: # Only include rows with actual note content
-                 notes_list.append({"date": date_str, "note": note_str})
-        except Exception as conv_e:
-            print(f"[{request_id}] Error converting note row to dict for patient {patient_id}: {conv_e}")
-            # Continue processing other notes
+    Args:
+        notes_list: Notes to summarize, as [{"date": ..., "note": ...}] from the notes index.
+        patient_id: The ID of the patient whose notes are summarized, for logging.
+        request_id: The ID of the current request for logging and cancellation checks.
+        previous_summary: Summary of the patient's earlier notes, to be updated with notes_list.
 
+    Returns:
+        A dictionary containing the summarized notes under the key "summary",
+        or an error message under the key "error".
+    """
     if not notes_list:
-        return {"summary": "No valid notes found for processing after filtering."}
+        return {"summary": "No notes available for this patient."} # Return summary indicating no notes
+    if len(notes_list) == 1 and previous_summary is None:
+        # A single note is its own summary; no themes to group
+        print(f"[{request_id}] Patient {patient_id} has a single note; using it as the summary without AI.")
+        return {"summary": f"{notes_list[0]['date']}: {notes_list[0]['note']}"}
 
-    # --- 3. Cancellation Check Before LLM Call ---
+    # --- 1. Cancellation Check Before LLM Call ---
     with active_requests_lock:
         request_info = active_requests.get(request_id)
         if request_info and request_info.get("cancel_requested", False):
             print(f"[{request_id}] Cancellation detected before nurse notes summarization.")
             raise CancelledError(f"Request {request_id} cancelled before nurse note AI.")
 
-    # --- 4. Summarize Notes using LLM ---
-    if not nurseNotesChain:
-        print(f"[{request_id}] Error: NurseNotesChain (LLM) is not available.")
+    # --- 2. Summarize Notes using LLM ---
+    if not model:
+        print(f"[{request_id}] Error: Nurse notes LLM is not available.")
         return {"error": "Notes processing service unavailable."}
 
     try:
-        print(f"[{request_id}] Processing {len(notes_list)} nurse notes using AI for summarization...")
         nurse_start_time = time.time()
         # Pass the list of dictionaries directly to the template
-        nurse_notes_result = nurseNotesChain.invoke({"nurse_notes": notes_list})
+        if previous_summary is not None:
+            print(f"[{request_id}] Updating nurse notes summary with {len(notes_list)} new notes using AI...")
+            nurse_notes_prompt = renderNurseNotesUpdatePrompt(previous_summary=previous_summary, nurse_notes=notes_list)
+        else:
+            print(f"[{request_id}] Processing {len(notes_list)} nurse notes using AI for summarization...")
+            nurse_notes_prompt = renderNurseNotesPrompt(nurse_notes=notes_list)
+        with llm_slot(request_id):
+            nurse_notes_result = model.invoke(nurse_notes_prompt)
         nurse_end_time = time.time()
         print(f"[{request_id}] Nurse Notes AI Summarization time: {nurse_end_time - nurse_start_time:.2f} seconds")
 
@@ -503,7 +1130,7 @@ def get_patient_notes(patient_id: str, request_id: str) -> Dict[str, Any]:
              return {"summary": nurse_notes_result}
         else:
              # Attempt to convert unexpected result type to string
-             print(f"[{request_id}] Warning: Unexpected type from nurseNotesChain: {type(nurse_notes_result)}. Converting to string.")
+             print(f"[{request_id}] Warning: Unexpected type from nurse notes LLM: {type(nurse_notes_result)}. Converting to string.")
              return {"summary": str(nurse_notes_result)}
 
     except CancelledError:
@@ -514,6 +1141,66 @@ def get_patient_notes(patient_id: str, request_id: str) -> Dict[str, Any]:
         traceback.print_exc()
         return {"error": f"Error summarizing nurse notes: {e}"}
 
+# --- LLM Calls ---
+@contextlib.contextmanager
+def llm_slot(request_id: str):
+    """
+    Holds one of Ollama's parallel generation slots for the duration of an LLM call.
+    While all slots are busy the caller waits here, checking for cancellation of its request,
+    so cancelled requests never reach the model.
+
+    Args:
+        request_id: Unique identifier of the request making the call.
+
+    Raises:
+        CancelledError: If the request is cancelled while waiting for a slot.
+    """
+    while not llm_slots.acquire(timeout=LLM_SLOT_POLL_SECONDS):
+        with active_requests_lock:
+            request_info = active_requests.get(request_id)
+            if request_info and request_info.get("cancel_requested", False):
+                print(f"[{request_id}] Cancellation detected while waiting for an LLM slot.")
+                raise CancelledError(f"Request {request_id} cancelled while waiting for an LLM slot.")
+    try:
+        yield
+    finally:
+        llm_slots.release()
+
+
+def _stream_llm_response(prompt: str, request_id: str) -> str:
+    """
+    Runs the LLM in streaming mode, publishing the text generated so far as the request's
+    "partial_response" (visible via /status and /stream) while the model is still generating.
+    Generation is stopped as soon as cancellation of the request is requested.
+
+    Args:
+        prompt: The rendered prompt.
+        request_id: Unique identifier of the request being processed.
+
+    Returns:
+        The complete generated text.
+
+    Raises:
+        CancelledError: If the request is cancelled while the model is generating.
+    """
+    response_text = ""
+    with llm_slot(request_id):
+        stream = model.stream(prompt)
+        try:
+            for chunk in stream:
+                response_text += str(chunk)
+                with active_requests_lock:
+                    request_info = active_requests.get(request_id)
+                    if request_info:
+                        if request_info.get("cancel_requested", False):
+                            print(f"[{request_id}] Cancellation detected while streaming the AI response.")
+                            raise CancelledError(f"Request {request_id} cancelled during AI response generation.")
+                        request_info["partial_response"] = response_text
+                        active_requests_changed.notify_all()
+        finally:
+            stream.close() # Closes the connection to Ollama, which stops generation if we exit early
+    return response_text
+
 
 # --- Core Request Processing Functions ---
 
@@ -548,7 +1235,7 @@ def process_chat(data: Dict[str, Any], request_id: str, handsfree: bool) -> Dict
         print(f"[{request_id}] Error: Missing user_id or message.")
         # Return an error structure compatible with _handle_future_completion
         return {"error": "Missing user_id or message in chat request"}
-    if not chatChain:
+    if not model:
         print(f"[{request_id}] Error: Chat service unavailable (LLM not initialized).")
         return {"error": "Chat service unavailable."}
 
@@ -558,20 +1245,25 @@ def process_chat(data: Dict[str, Any], request_id: str, handsfree: bool) -> Dict
         patient_details_in_context: Optional[Dict[str, Any]] = None
         patient_id_in_context: Optional[str] = None
         summarized_notes: Any = {"summary": "No patient context set or notes unavailable."} # Default notes state
-        chat_history_list: List[Dict[str, str]] = []
-
-        # --- Lock User Context for Reading/Updating ---
-        with user_contexts_lock:
+        chat_history_str: str = ""
+
+        # --- Snapshot User Context ---
+        # The user's own lock (and user_contexts_lock, for the shared dict) is held only to read the
+        # context here and to publish changes below. Notes fetches (LLM calls) run with no lock held:
+        # concurrent fetches of the same summary share one LLM call (see get_patient_notes), and a
+        # publish first re-checks that the context still holds the patient it was read for.
+        with _get_user_lock(user_id), user_contexts_lock:
             # Ensure user context entry exists
             if user_id not in user_contexts:
                 user_contexts[user_id] = {
                     "patient_id": None, "patient_details": None,
-                    "summarized_notes": None, "chat_history": []
+                    "summarized_notes": None, "chat_history": [], "chat_history_str": ""
                 }
             user_context_data = user_contexts[user_id]
             patient_id_in_context = user_context_data.get("patient_id")
             patient_details_in_context = user_context_data.get("patient_details")
-            chat_history_list = user_context_data.get("chat_history", []) # Load current history
+            notes_in_context = user_context_data.get("summarized_notes")
+            chat_history_str = user_context_data.get("chat_history_str", "") # Load pre-formatted history
 
         # --- Identify Patient in User Input ---
         # Use the helper function to check the current user message
@@ -582,67 +1274,61 @@ def process_chat(data: Dict[str, Any], request_id: str, handsfree: bool) -> Dict
         if identified_patient_info:
             new_patient_details, new_patient_id = identified_patient_info
 
-            # --- Update User Context if New Patient Identified ---
-            if new_patient_id and new_patient_id != patient_id_in_context:
-                print(f"[{request_id}] New patient context detected in input for user {user_id}: ID {new_patient_id}. Resetting context.")
-                with user_contexts_lock:
-                    # Fetch notes for the *new* patient (this involves an LLM call)
-                    summarized_notes = get_patient_notes(new_patient_id, request_id)
-                    # Check for cancellation *after* potential notes call
-                    request_info_check = active_requests.get(request_id)
-                    if request_info_check and request_info_check.get("cancel_requested", False):
-                         raise CancelledError(f"Request {request_id} cancelled during patient context switch.")
-
+        # --- Update User Context if New Patient Identified ---
+        if new_patient_id and new_patient_id != patient_id_in_context:
+            print(f"[{request_id}] New patient context detected in input for user {user_id}: ID {new_patient_id}. Resetting context.")
+            # Fetch notes for the *new* patient (this involves an LLM call)
+            summarized_notes = get_patient_notes(new_patient_id, request_id)
+            # Check for cancellation *after* potential notes call
+            request_info_check = active_requests.get(request_id)
+            if request_info_check and request_info_check.get("cancel_requested", False):
+                 raise CancelledError(f"Request {request_id} cancelled during patient context switch.")
+
+            with _get_user_lock(user_id), user_contexts_lock:
+                user_context_data = user_contexts.get(user_id)
+                # Another request of this user may have switched patients while notes were being fetched
+                if user_context_data is None or user_context_data.get("patient_id") == patient_id_in_context:
                     user_contexts[user_id] = {
                         "patient_id": new_patient_id,
                         "patient_details": new_patient_details,
                         "summarized_notes": summarized_notes, # Store the fetched/summarized notes
-                        "chat_history": [] # Reset history for new patient
+                        "chat_history": [], # Reset history for new patient
+                        "chat_history_str": ""
                     }
-                    # Update local variables for the rest of this request
-                    patient_id_in_context = new_patient_id
-                    patient_details_in_context = new_patient_details
-                    chat_history_list = []
-            elif new_patient_id and new_patient_id == patient_id_in_context:
-                 print(f"[{request_id}] Patient mentioned in input ({new_patient_id}) matches current context.")
-                 # Patient context is already correct. Ensure notes are loaded if missing.
-                 with user_contexts_lock:
-                      if not user_contexts[user_id].get("summarized_notes") and patient_id_in_context:
-                           print(f"[{request_id}] Notes were missing for current patient {patient_id_in_context}, fetching now.")
-                           summarized_notes = get_patient_notes(patient_id_in_context, request_id)
-                           # Check for cancellation again
-                           request_info_check = active_requests.get(request_id)
-                           if request_info_check and request_info_check.get("cancel_requested", False):
-                               raise CancelledError(f"Request {request_id} cancelled while fetching missing notes.")
-                           user_contexts[user_id]["summarized_notes"] = summarized_notes
-                      else:
-                           # Notes already loaded, use them
-                           summarized_notes = user_contexts[user_id].get("summarized_notes", summarized_notes) # Use existing or default
-
+                else:
+                    print(f"[{request_id}] Patient context for user {user_id} changed meanwhile; answering for {new_patient_id} without switching it.")
+            # Update local variables for the rest of this request
+            patient_id_in_context = new_patient_id
+            patient_details_in_context = new_patient_details
+            chat_history_str = ""
         else:
-            # No patient identified in the *current* input. Use existing context.
-            print(f"[{request_id}] No new patient identified in input. Using existing context (Patient ID: {patient_id_in_context}).")
+            if new_patient_id:
+                print(f"[{request_id}] Patient mentioned in input ({new_patient_id}) matches current context.")
+            else:
+                # No patient identified in the *current* input. Use existing context.
+                print(f"[{request_id}] No new patient identified in input. Using existing context (Patient ID: {patient_id_in_context}).")
             # Ensure notes are loaded if context exists but notes are missing
-            with user_contexts_lock:
-                 if patient_id_in_context and not user_contexts[user_id].get("summarized_notes"):
-                      print(f"[{request_id}] Notes were missing for current patient {patient_id_in_context}, fetching now.")
-                      summarized_notes = get_patient_notes(patient_id_in_context, request_id)
-                      request_info_check = active_requests.get(request_id)
-                      if request_info_check and request_info_check.get("cancel_requested", False):
-                            raise CancelledError(f"Request {request_id} cancelled while fetching missing notes.")
-                      user_contexts[user_id]["summarized_notes"] = summarized_notes
-                 elif patient_id_in_context:
-                      # Notes exist, use them
-                      summarized_notes = user_contexts[user_id].get("summarized_notes", summarized_notes)
-                 # else: No patient context, notes remain default
+            if patient_id_in_context and not notes_in_context:
+                print(f"[{request_id}] Notes were missing for current patient {patient_id_in_context}, fetching now.")
+                summarized_notes = get_patient_notes(patient_id_in_context, request_id)
+                request_info_check = active_requests.get(request_id)
+                if request_info_check and request_info_check.get("cancel_requested", False):
+                    raise CancelledError(f"Request {request_id} cancelled while fetching missing notes.")
+                with _get_user_lock(user_id), user_contexts_lock:
+                    user_context_data = user_contexts.get(user_id)
+                    # A reset or /record may have replaced the context while notes were being fetched
+                    if user_context_data and user_context_data.get("patient_id") == patient_id_in_context:
+                        user_context_data["summarized_notes"] = summarized_notes
+            elif patient_id_in_context:
+                # Notes exist, use them
+                summarized_notes = notes_in_context
+            # else: No patient context, notes remain default
 
         # --- Prepare Final Context for LLM ---
         # Convert current patient details (which might be None) to string
         current_patient_details_str = patient_details_to_string(patient_details_in_context)
-        # Format chat history
-        context_history_str = "\nChat History:\n" + "\n".join(
-            [f"User: {entry['user']}\nAI: {entry['ai']}" for entry in chat_history_list[-10:]] # Limit history length
-        )
+        # Chat history is kept trimmed and pre-formatted in the user context
+        context_history_str = "\nChat History:\n" + chat_history_str
         full_context_for_llm = current_global_context + context_history_str
 
         # --- Cancellation Check before Main LLM Call ---
@@ -659,60 +1345,36 @@ def process_chat(data: Dict[str, Any], request_id: str, handsfree: bool) -> Dict
                 print(f"[{request_id}] Warning: request_info not found during pre-LLM check. Proceeding anyway.")
 
         # --- Invoke Chat LLM ---
-        print(f"[{request_id}] Calling chat chain...")
+        print(f"[{request_id}] Calling chat LLM...")
         ai_start_time = time.time()
         current_time_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-        chat_result = chatChain.invoke({
-            "current_time": current_time_str,
-            "context": full_context_for_llm,
-            "question": user_input,
-            "patient_details": current_patient_details_str,
-            "nurse_notes_result": summarized_notes.get("summary", "Notes processing error or not available.") if isinstance(summarized_notes, dict) else str(summarized_notes) # Pass summary or error message
-        })
+        chat_result = _stream_llm_response(renderChatPrompt(
+            current_time=current_time_str,
+            context=full_context_for_llm,
+            question=user_input,
+            patient_details=current_patient_details_str,
+            nurse_notes_result=summarized_notes.get("summary", "Notes processing error or not available.") if isinstance(summarized_notes, dict) else str(summarized_notes) # Pass summary or error message
+        ), request_id)
         ai_end_time = time.time()
-        print(f"[{request_id}] Chat chain response received ({ai_end_time - ai_start_time:.2f}s).")
+        print(f"[{request_id}] Chat LLM response received ({ai_end_time - ai_start_time:.2f}s).")
 
         # --- Update Chat History ---
         with user_contexts_lock:
-            # Check user_id exists again in case of rare edge cases
-            if user_id in user_contexts:
-                # Ensure 'chat_history' key exists and is a list
-                if not isinstance(user_contexts[user_id].get("chat_history"), list):
-                     user_contexts[user_id]["chat_history"] = []
-                user_contexts[user_id]["chat_history"].append({"user": user_input, "ai": chat_result})
+            # Check user_id exists again in case of rare edge cases, and that no other request
+            # switched this user to another patient while this one was running unlocked
+            if user_id in user_contexts and user_contexts[user_id].get("patient_id") == patient_id_in_context:
+                append_chat_history(user_contexts[user_id], user_input, chat_result)
             else:
-                # This shouldn't happen if context was created earlier, but log if it does
-                print(f"[{request_id}] Warning: User context for {user_id} disappeared before saving chat history.")
+                print(f"[{request_id}] Warning: User context for {user_id} was reset or switched patients; chat history not saved.")
 
         # --- Prepare Final Response ---
         final_response_string = str(chat_result) # Ensure it's a string
 
         # --- Handsfree Prefix Modification ---
         if handsfree:
-            prefix = ""
-            patient_name_hf = None
-            ssn_hf = None
-
             # Use patient_details_in_context which reflects the active patient for this response
-            if patient_details_in_context:
-                patient_name_hf = patient_details_in_context.get(PATIENT_NAME_COLUMN_NAME)
-                ssn_hf = patient_details_in_context.get(SSN_COLUMN_NAME)
-
-                if patient_name_hf and ssn_hf:
-                    ssn_str = str(ssn_hf)
-                    # Check length for safety, HETU is longer but standard SSN might be shorter
-                    if len(ssn_str) >= 4:
-                        ssn_last_four = ssn_str[-4:]
-                        prefix = f"For {patient_name_hf} with SSN ID ending in {ssn_last_four}, "
-                        print(f"[{request_id}] Applying handsfree prefix.")
-                        final_response_string = prefix + final_response_string
-                    else:
-                        print(f"[{request_id}] Handsfree active, but SSN '{ssn_str}' too short for prefix.")
-                else:
-                    print(f"[{request_id}] Handsfree active, but missing patient name or SSN in context for prefix.")
-            else:
-                 print(f"[{request_id}] Handsfree active, but no patient context available for prefix.")
+            final_response_string = handsfree_prefix(patient_details_in_context, request_id) + final_response_string
 
         # --- Structure the Successful Result ---
         response_data = {
@@ -760,7 +1422,7 @@ def process_record(data: Dict[str, Any], request_id: str, handsfree: bool) -> Di
     if not user_id or not patient_note:
         print(f"[{request_id}] Error: Missing user_id or message (note content).")
         return {"error": "Missing user_id or message in record request"}
-    if not recordChain:
+    if not model:
         print(f"[{request_id}] Error: Record service unavailable (LLM not initialized).")
         return {"error": "Record confirmation service unavailable."}
 
@@ -768,15 +1430,16 @@ def process_record(data: Dict[str, Any], request_id: str, handsfree: bool) -> Di
         # --- Determine Patient Context (Required for Recording) ---
         patient_id: Optional[str] = None
         patient_details: Optional[Dict[str, Any]] = None
-        chat_history_list: List[Dict[str, str]] = [] # For confirmation context
+        recent_chat_history: List[Dict[str, str]] = [] # For confirmation context
 
         # 1. Check existing user context first
-        with user_contexts_lock:
+        with _get_user_lock(user_id), user_contexts_lock:
             if user_id in user_contexts and user_contexts[user_id].get("patient_id"):
                 user_context_data = user_contexts[user_id]
                 patient_id = user_context_data["patient_id"]
                 patient_details = user_context_data.get("patient_details")
-                chat_history_list = user_context_data.get("chat_history", [])
+                # Copy just the turns the prompt needs; the live list keeps changing after the lock is released
+                recent_chat_history = user_context_data.get("chat_history", [])[-RECORD_HISTORY_PROMPT_TURNS:]
                 print(f"[{request_id}] Patient ID {patient_id} found in existing context for record.")
             else:
                 # 2. If no context, try identifying patient from the note content itself
@@ -786,14 +1449,15 @@ def process_record(data: Dict[str, Any], request_id: str, handsfree: bool) -> Di
                     patient_details, patient_id = identified_patient_info
                     print(f"[{request_id}] Patient ({patient_id}) identified in record note. Setting context.")
                     # Update context immediately (reset history and fetch notes if needed later)
-                    # For recording, we mainly need the ID/details now. Notes aren't directly used by recordChain.
+                    # For recording, we mainly need the ID/details now. Notes aren't directly used by the record prompt.
                     user_contexts[user_id] = {
                          "patient_id": patient_id,
                          "patient_details": patient_details,
                          "summarized_notes": None, # Mark notes as not yet fetched for this context
-                         "chat_history": [] # Reset history as patient context was just established
+                         "chat_history": [], # Reset history as patient context was just established
+                         "chat_history_str": ""
                     }
-                    chat_history_list = [] # Reset local history variable
+                    recent_chat_history = [] # Reset local history variable
                 else:
                     # If no patient in context AND none found in note, this is an error
                     print(f"[{request_id}] Error: Patient context not set and no patient identifiable in note.")
@@ -806,30 +1470,26 @@ def process_record(data: Dict[str, Any], request_id: str, handsfree: bool) -> Di
             return {"error": "Internal error: Patient context could not be finalized."}
 
         # --- Write Note to CSV ---
-        # Basic CSV safety: replace newlines, wrap in quotes if comma or quote exists.
-        safe_note = str(patient_note).replace('\n', ' ').replace('\r', '')
-        if ',' in safe_note or '"' in safe_note:
-            safe_note = f'"{safe_note.replace("\"", "\"\"")}"' # CSV standard: double internal quotes
-
-        new_note_csv_line = f"{current_date_str},{user_id},{patient_id},{safe_note}\n"
+        # Keep each note on one line; csv.writer quotes any field containing a comma or quote.
+        # Strip it as reading the file back does (skipinitialspace), so the index matches a reload.
+        note_text = str(patient_note).translate(NOTE_NEWLINE_TRANSLATION).strip()
+        if not note_text:
+            print(f"[{request_id}] Error: Note is empty after removing whitespace.")
+            return {"error": "Failed to save nurse note: the note is empty."}
+        csv_buffer = io.StringIO()
+        csv.writer(csv_buffer, lineterminator="\n").writerow([current_date_str, user_id, patient_id, note_text])
+        new_note_csv_line = csv_buffer.getvalue()
 
         try:
-            # Use 'a+' to create if not exists, append otherwise.
-            # Consider a dedicated file lock (e.g., threading.Lock) if high concurrent writes are expected
-            # file_write_lock = threading.Lock() # Example
-            # with file_write_lock:
-            with open(NURSE_NOTES_PATH, 'a+', encoding='utf-8') as file: # Specify encoding
-                # Check if file is empty to write header
-                file.seek(0, os.SEEK_END)
-                if file.tell() == 0:
-                    file.write(f"{NOTES_DATE_COLUMN},{NOTES_NURSE_ID_COLUMN},{NOTES_PATIENT_ID_COLUMN},{NOTES_NOTE_COLUMN}\n") # Use constants for header
-                # Write the new note
-                file.write(new_note_csv_line)
-            print(f"[{request_id}] Note for patient {patient_id} saved to {NURSE_NOTES_PATH}")
-        except IOError as e:
-            print(f"[{request_id}] Error writing note to {NURSE_NOTES_PATH}: {e}")
-            traceback.print_exc()
-            return {"error": f"Failed to save nurse note: {e}"}
+            # Indexes the note now; the background writer appends it to the file
+            save_nurse_note(patient_id, current_date_str, note_text, new_note_csv_line)
+            print(f"[{request_id}] Note for patient {patient_id} queued for saving to {NURSE_NOTES_PATH}")
+        except UnicodeEncodeError as e:
+            print(f"[{request_id}] Error: Note contains characters that cannot be saved: {e}")
+            return {"error": "Failed to save nurse note: it contains characters that cannot be saved. Please check the note text."}
+        except queue.Full:
+            print(f"[{request_id}] Error: Notes writer backlog is full ({NOTES_WRITE_QUEUE_SIZE} notes). Note not saved.")
+            return {"error": "Failed to save nurse note: the server is busy saving other notes. Please try again."}
         except Exception as e: # Catch other potential errors
              print(f"[{request_id}] Unexpected error during note saving: {e}")
              traceback.print_exc()
@@ -838,9 +1498,9 @@ def process_record(data: Dict[str, Any], request_id: str, handsfree: bool) -> Di
         # --- Prepare Context for Confirmation LLM ---
         # Use patient details determined earlier
         current_patient_details_str = patient_details_to_string(patient_details)
-        # Format chat history for context (use potentially updated chat_history_list)
+        # Format chat history for context (use potentially updated recent_chat_history)
         context_history_str = "\nChat History:\n" + "\n".join(
-            [f"User: {entry['user']}\nAI: {entry['ai']}" for entry in chat_history_list[-5:]] # Shorter history for confirmation
+            [format_chat_turn(entry) for entry in recent_chat_history] # Shorter history for confirmation
         )
         full_context_for_llm = global_context + context_history_str # Use global context base
 
@@ -852,23 +1512,21 @@ def process_record(data: Dict[str, Any], request_id: str, handsfree: bool) -> Di
                 raise CancelledError(f"Request {request_id} cancelled before record confirmation AI.")
 
         # --- Invoke Confirmation LLM ---
-        print(f"[{request_id}] Calling record confirmation chain...")
+        print(f"[{request_id}] Calling record confirmation LLM...")
         ai_start_time = time.time()
-        record_result = recordChain.invoke({
-            "context": full_context_for_llm,
-            "patient_details": current_patient_details_str,
-            "patient_note": patient_note # Pass the original note for context
-        })
+        record_result = _stream_llm_response(renderRecordPrompt(
+            context=full_context_for_llm,
+            patient_details=current_patient_details_str,
+            patient_note=patient_note # Pass the original note for context
+        ), request_id)
         ai_end_time = time.time()
-        print(f"[{request_id}] Record confirmation chain response received ({ai_end_time - ai_start_time:.2f}s).")
+        print(f"[{request_id}] Record confirmation LLM response received ({ai_end_time - ai_start_time:.2f}s).")
 
         # --- Update Chat History with Record Action & Confirmation ---
         with user_contexts_lock:
             if user_id in user_contexts:
-                 if not isinstance(user_contexts[user_id].get("chat_history"), list):
-                      user_contexts[user_id]["chat_history"] = []
                  # Add a combined entry showing the action and the AI's confirmation
-                 user_contexts[user_id]["chat_history"].append({"user": f"Note Recorded: '{patient_note[:50]}...'", "ai": record_result}) # Log truncated note
+                 append_chat_history(user_contexts[user_id], f"Note Recorded: '{patient_note[:50]}...'", record_result) # Log truncated note
             else:
                  print(f"[{request_id}] Warning: User context for {user_id} disappeared before saving record history.")
 
@@ -879,26 +1537,8 @@ def process_record(data: Dict[str, Any], request_id: str, handsfree: bool) -> Di
 
         # --- Handsfree Prefix Modification ---
         if handsfree:
-            prefix = ""
             # Use patient_details established earlier in this function
-            if patient_details:
-                patient_name_hf = patient_details.get(PATIENT_NAME_COLUMN_NAME)
-                ssn_hf = patient_details.get(SSN_COLUMN_NAME)
-
-                if patient_name_hf and ssn_hf:
-                    ssn_str = str(ssn_hf)
-                    if len(ssn_str) >= 4:
-                        ssn_last_four = ssn_str[-4:]
-                        prefix = f"For {patient_name_hf} with SSN ID ending in {ssn_last_four}, "
-                        print(f"[{request_id}] Applying handsfree prefix to record confirmation.")
-                        final_response_string = prefix + final_response_string
-                    else:
-                        print(f"[{request_id}] Handsfree active, but SSN '{ssn_str}' too short for record prefix.")
-                else:
-                    print(f"[{request_id}] Handsfree active, but missing patient name or SSN for record prefix.")
-            else:
-                 # This case should not happen due to earlier checks, but log if it does
-                 print(f"[{request_id}] Handsfree active, but patient details were unexpectedly missing for prefix.")
+            final_response_string = handsfree_prefix(patient_details, request_id) + final_response_string
 
         # --- Structure the Successful Result ---
         response_data = {
@@ -935,7 +1575,7 @@ def _handle_future_completion(request_id: str, future: Future):
             return
 
         request_info = active_requests[request_id]
-        now = datetime.datetime.now() # Record completion time
+        now = time.monotonic() # Record completion time
 
         # Avoid double-processing if status was already finalized (e.g., by /cancel)
         if request_info["status"] not in ["processing", "cancelling"]:
@@ -980,6 +1620,7 @@ def _handle_future_completion(request_id: str, future: Future):
         # Always update the timestamp when the final state is determined
         request_info["timestamp"] = now
         print(f"[{request_id}] Final state set to '{request_info['status']}' by completion handler.")
+        active_requests_changed.notify_all() # Wake /stream listeners so they can send the final event
 
 
 # --- API Endpoints ---
@@ -993,24 +1634,35 @@ def chat_submit():
     """
     request_id = str(uuid.uuid4())
     try:
-        data = request.json
-        if not data: raise ValueError("Request body must be JSON.")
+        data = request.get_json(silent=True) # None for a missing or malformed body
+        if not isinstance(data, dict): return jsonify({"error": "Request body must be a JSON object."}), 400
         user_id = data.get("user_id")
         handsfree_flag = data.get("handsfree", False) # Extract handsfree flag (default False)
         if not user_id: return jsonify({"error": "user_id is required"}), 400
         if not data.get("message"): return jsonify({"error": "message is required"}), 400
+        if len(str(data["message"])) > MAX_MESSAGE_CHARS: return jsonify({"error": f"Message is too long (max {MAX_MESSAGE_CHARS} characters)."}), 413
 
         print(f"[{request_id}] Received /chat request from user {user_id}, handsfree={handsfree_flag}")
 
+        # Reject rather than queue without bound while the workers are saturated
+        if not request_slots.acquire(blocking=False):
+            print(f"[{request_id}] Rejecting /chat request from user {user_id}: all {MAX_WORKERS + MAX_QUEUED_REQUESTS} request slots busy.")
+            return jsonify({"error": "Server is busy, please try again shortly."}), 503
+
         # Submit the processing function to the executor
-        future = executor.submit(process_chat, data, request_id, handsfree_flag)
+        try:
+            future = executor.submit(process_chat, data, request_id, handsfree_flag)
+        except Exception:
+            request_slots.release()
+            raise
+        future.add_done_callback(lambda f: request_slots.release())
 
         # Store future and initial state
         with active_requests_lock:
             active_requests[request_id] = {
                 "future": future, "status": "processing", "result": None,
                 "cancel_requested": False, "user_id": user_id,
-                "timestamp": datetime.datetime.now() # Record submission time
+                "timestamp": time.monotonic() # Record submission time
             }
 
         # Add the completion handler callback
@@ -1033,24 +1685,35 @@ def record_submit():
     """
     request_id = str(uuid.uuid4())
     try:
-        data = request.json
-        if not data: raise ValueError("Request body must be JSON.")
+        data = request.get_json(silent=True) # None for a missing or malformed body
+        if not isinstance(data, dict): return jsonify({"error": "Request body must be a JSON object."}), 400
         user_id = data.get("user_id")
         handsfree_flag = data.get("handsfree", False) # Extract handsfree flag
         if not user_id: return jsonify({"error": "user_id is required"}), 400
         if not data.get("message"): return jsonify({"error": "message (note content) is required"}), 400
+        if len(str(data["message"])) > MAX_MESSAGE_CHARS: return jsonify({"error": f"Note is too long (max {MAX_MESSAGE_CHARS} characters)."}), 413
 
         print(f"[{request_id}] Received /record request from user {user_id}, handsfree={handsfree_flag}")
 
+        # Reject rather than queue without bound while the workers are saturated
+        if not request_slots.acquire(blocking=False):
+            print(f"[{request_id}] Rejecting /record request from user {user_id}: all {MAX_WORKERS + MAX_QUEUED_REQUESTS} request slots busy.")
+            return jsonify({"error": "Server is busy, please try again shortly."}), 503
+
         # Submit the processing function to the executor
-        future = executor.submit(process_record, data, request_id, handsfree_flag)
+        try:
+            future = executor.submit(process_record, data, request_id, handsfree_flag)
+        except Exception:
+            request_slots.release()
+            raise
+        future.add_done_callback(lambda f: request_slots.release())
 
         # Store future and initial state
         with active_requests_lock:
              active_requests[request_id] = {
                  "future": future, "status": "processing", "result": None,
                  "cancel_requested": False, "user_id": user_id,
-                 "timestamp": datetime.datetime.now()
+                 "timestamp": time.monotonic()
              }
 
         # Add the completion handler callback
@@ -1096,7 +1759,7 @@ def cancel_request(request_id: str):
                         # The callback (_handle_future_completion) will ultimately set the final 'cancelled' state.
                         # We mark it as 'cancelling' here to indicate the attempt.
                         request_info["status"] = "cancelling"
-                        request_info["timestamp"] = datetime.datetime.now() # Update timestamp on state change
+                        request_info["timestamp"] = time.monotonic() # Update timestamp on state change
                         message = f"Cancellation requested. Attempting interruption (success={cancelled_attempt}). Final status pending."
                         status_code = 200
                         print(f"[{request_id}] Marked as 'cancelling', future.cancel() returned {cancelled_attempt}")
@@ -1164,6 +1827,8 @@ def get_status(request_id: str):
             elif current_status == "processing":
                 status_to_return = 200 # Still processing
                 response_data = {"status": "processing", "request_id": request_id}
+                if request_info.get("partial_response"):
+                    response_data["partial_response"] = request_info["partial_response"] # Text generated so far
             else: # Should not happen, indicates an internal state issue
                 print(f"[{request_id}] Error: Request found in unknown state '{current_status}'.")
                 status_to_return = 500
@@ -1184,6 +1849,59 @@ def get_status(request_id: str):
     return jsonify(response_data), status_to_return
 
 
+@app.route('/stream/<request_id>', methods=['GET'])
+def stream_request(request_id: str):
+    """
+    API endpoint to follow a request's AI response as it is generated, as Server-Sent Events.
+    Each text chunk is sent as a "data:" event holding a JSON-encoded string. When the request
+    reaches a final state, a "done" event is sent with the same payload /status would return.
+    Unlike /status, this does not remove the request entry; it ages out via background cleanup.
+    Returns: text/event-stream response, or 404 JSON if the request is unknown.
+    """
+    print(f"[{request_id}] Received stream request.")
+    with active_requests_lock:
+        if request_id not in active_requests:
+            return jsonify({"status": "not found", "request_id": request_id}), 404
+
+    def has_update(sent_length: int) -> bool:
+        # Called with active_requests_lock held
+        request_info = active_requests.get(request_id)
+        return (not request_info
+                or request_info["status"] not in ["processing", "cancelling"]
+                or len(request_info.get("partial_response", "")) > sent_length)
+
+    def generate_events():
+        sent_length = 0
+        while True:
+            with active_requests_changed:
+                active_requests_changed.wait_for(lambda: has_update(sent_length), timeout=STREAM_KEEPALIVE_SECONDS)
+                request_info = active_requests.get(request_id)
+                if not request_info:
+                    yield f"event: done\ndata: {json.dumps({'status': 'not found', 'request_id': request_id})}\n\n"
+                    return
+                current_status = request_info["status"]
+                partial_response = request_info.get("partial_response", "")
+                result = request_info.get("result")
+
+            if len(partial_response) > sent_length:
+                yield f"data: {json.dumps(partial_response[sent_length:])}\n\n"
+                sent_length = len(partial_response)
+            elif current_status in ["processing", "cancelling"]:
+                yield ": keep-alive\n\n"
+
+            if current_status == "completed":
+                yield f"event: done\ndata: {json.dumps({'status': 'completed', 'request_id': request_id, 'data': result})}\n\n"
+                return
+            elif current_status == "error":
+                yield f"event: done\ndata: {json.dumps({'status': 'error', 'request_id': request_id, 'error': result})}\n\n"
+                return
+            elif current_status == "cancelled":
+                yield f"event: done\ndata: {json.dumps({'status': 'cancelled', 'request_id': request_id, 'message': result})}\n\n"
+                return
+
+    return Response(stream_with_context(generate_events()), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
 # --- Background Cleanup Thread ---
 def background_cleanup():
     """
@@ -1196,7 +1914,7 @@ def background_cleanup():
     while True:
         try: # Wrap outer loop in try/except to prevent thread death on unexpected error
             time.sleep(CLEANUP_INTERVAL_SECONDS)
-            now = datetime.datetime.now()
+            now = time.monotonic()
             cleaned_count = 0
             timed_out_count = 0
 
@@ -1214,13 +1932,13 @@ def background_cleanup():
 
                     # Check terminal states for staleness
                     if info["status"] in ["completed", "error", "cancelled"]:
-                        if (now - timestamp).total_seconds() > STALE_REQUEST_THRESHOLD_SECONDS:
+                        if now - timestamp > STALE_REQUEST_THRESHOLD_SECONDS:
                             ids_to_remove.append(req_id)
                             cleaned_count += 1
 
                     # Optional: Timeout for 'processing' or 'cancelling' states
                     elif PROCESSING_TIMEOUT_SECONDS > 0 and info["status"] in ["processing", "cancelling"]:
-                        if (now - timestamp).total_seconds() > PROCESSING_TIMEOUT_SECONDS:
+                        if now - timestamp > PROCESSING_TIMEOUT_SECONDS:
                              print(f"[Cleanup] Request {req_id} stuck in '{info['status']}' state for > {PROCESSING_TIMEOUT_SECONDS}s. Marking as timed out error.")
                              # Mark as error and schedule for removal (it will be removed on next cycle if not polled)
                              info["status"] = "error"
@@ -1233,12 +1951,18 @@ def background_cleanup():
                 # Remove identified stale entries
                 for req_id in ids_to_remove:
                     if req_id in active_requests:
-                        print(f"[Cleanup] Removing stale request {req_id} (Status: {active_requests[req_id]['status']}, Age: {(now - active_requests[req_id]['timestamp']).total_seconds():.0f}s)")
+                        print(f"[Cleanup] Removing stale request {req_id} (Status: {active_requests[req_id]['status']}, Age: {now - active_requests[req_id]['timestamp']:.0f}s)")
                         del active_requests[req_id]
                     # else: already removed, possibly by /status endpoint
 
+            # Drop contexts (and their locks) of users idle for about a shift; they start afresh
+            with user_contexts_lock:
+                idle_count = user_contexts.evict_idle(USER_CONTEXT_IDLE_SECONDS)
+                user_locks.evict_idle(USER_CONTEXT_IDLE_SECONDS)
+
             if cleaned_count > 0: print(f"[Cleanup] Removed {cleaned_count} stale terminal requests.")
             if timed_out_count > 0: print(f"[Cleanup] Marked {timed_out_count} requests as timed out.")
+            if idle_count > 0: print(f"[Cleanup] Removed {idle_count} idle user contexts.")
 
         except Exception as cleanup_err:
             print(f"[Cleanup Thread Error] An error occurred during cleanup scan: {cleanup_err}")
@@ -1256,8 +1980,8 @@ def reset_user_context():
     Also attempts to cancel any active requests for that user.
     """
     try:
-        data = request.json
-        if not data: raise ValueError("Request body must be JSON.")
+        data = request.get_json(silent=True) # None for a missing or malformed body
+        if not isinstance(data, dict): return jsonify({"error": "Request body must be a JSON object."}), 400
         user_id = data.get("user_id")
         if not user_id: return jsonify({"error": "user_id is required"}), 400
 
@@ -1286,7 +2010,7 @@ def reset_user_context():
                          if not future.done():
                              if future.cancel():
                                  request_info["status"] = "cancelling"
-                                 request_info["timestamp"] = datetime.datetime.now()
+                                 request_info["timestamp"] = time.monotonic()
                                  cancelled_count += 1
                                  print(f"Request {req_id} cancellation initiated.")
                              else:
@@ -1310,7 +2034,8 @@ def reset_user_context():
                     "patient_id": None,
                     "patient_details": None,
                     "summarized_notes": None,
-                    "chat_history": []
+                    "chat_history": [],
+                    "chat_history_str": ""
                 }
                 print(f"User context reset successfully for user: {user_id}")
                 msg = f"User context reset. {cancelled_count}/{len(ids_to_cancel)} active requests processed for cancellation."
@@ -1333,8 +2058,8 @@ def set_global_context():
     """
     global global_context
     try:
-        data = request.json
-        if not data: raise ValueError("Request body must be JSON.")
+        data = request.get_json(silent=True) # None for a missing or malformed body
+        if not isinstance(data, dict): return jsonify({"error": "Request body must be a JSON object."}), 400
         new_context = data.get("context")
         if new_context is None: # Allow empty string but require key
             return jsonify({"error": "'context' key is required in JSON body"}), 400
@@ -1,5 +1,13 @@
 #!/bin/bash
 
+# Let Ollama serve several generations at once for concurrent chat/record
+# requests; main.py sizes its LLM slots (llm_slots) from the same variable.
+export OLLAMA_NUM_PARALLEL="${OLLAMA_NUM_PARALLEL:-4}"
+
+# Model served by main.py; general models like gemma3:4b need the system instructions
+export OLLAMA_MODEL_NAME="${OLLAMA_MODEL_NAME:-gemma3:4b}"
+export USE_SYSTEM_INSTRUCTIONS="${USE_SYSTEM_INSTRUCTIONS:-1}"
+
 # Start Ollama server in the background
 ollama serve &
 
@@ -7,7 +15,13 @@ ollama serve &
 ngrok http 5000 --url=fluent-macaw-suitably.ngrok-free.app --log=stdout &
 
 # Start your Flask application (or any other application)
-exec gunicorn -w 1 -t 4 -b 0.0.0.0:5000 gemma_main:app 
+# Request state (active requests, user contexts, notes index) lives in process
+# memory, so run ONE worker process and get concurrency from its threads: /status
+# polls must reach the process that owns the request. Threads also keep /stream
+# connections from blocking other clients, and keep-alive lets polling clients
+# reuse their connection.
+GUNICORN_THREADS="${GUNICORN_THREADS:-32}"
+exec gunicorn -w 1 -k gthread --threads "$GUNICORN_THREADS" --keep-alive 30 -t 120 -b 0.0.0.0:5000 main:app
 
 # Wait for any process to exit
 wait -n